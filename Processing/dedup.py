@@ -0,0 +1,86 @@
+import os
+import re
+import hashlib
+
+# "link" (default): store a near-duplicate chunk with a copy of the vector of the chunk it
+# repeats instead of embedding it again; search skips it while that chunk exists.
+# "skip": don't store it at all. "off": store and embed every chunk.
+NEAR_DUPLICATE_MODE = os.getenv("NEAR_DUPLICATE_MODE", "link")
+
+# Two chunks whose 64-bit SimHashes differ in at most this many bits count as near-duplicates.
+# Chunks are short (~800 chars), so a single changed word often flips 4-6 bits, while
+# unrelated chunks sit around 32 bits apart.
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "6"))
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def simhash(text: str) -> int:
+    """Returns the unsigned 64-bit SimHash of a chunk, built from its 3-word shingles."""
+    words = _WORD_RE.findall(text.lower())
+    if len(words) >= SHINGLE_SIZE:
+        features = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+    else:
+        features = [" ".join(words)]
+
+    weights = [0] * SIMHASH_BITS
+    for feature in features:
+        feature_hash = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            if feature_hash >> bit & 1:
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def to_signed(fingerprint: int) -> int:
+    """Postgres BIGINT is signed, so fingerprints are stored in two's complement."""
+    return fingerprint - (1 << SIMHASH_BITS) if fingerprint >= 1 << (SIMHASH_BITS - 1) else fingerprint
+
+
+def to_unsigned(fingerprint: int) -> int:
+    return fingerprint & ((1 << SIMHASH_BITS) - 1)
+
+
+class NearDuplicateIndex:
+    """Finds fingerprints within NEAR_DUPLICATE_MAX_DISTANCE bits of each other.
+
+    The 64 bits are split into max_distance + 1 bands. Two fingerprints that differ
+    in at most max_distance bits must agree exactly on at least one band, so only
+    fingerprints sharing a band are compared instead of the whole corpus.
+    """
+
+    def __init__(self, max_distance: int = NEAR_DUPLICATE_MAX_DISTANCE):
+        self.max_distance = max_distance
+        band_count = max_distance + 1
+        band_width = SIMHASH_BITS // band_count
+        self.bands = [
+            (i * band_width, SIMHASH_BITS if i == band_count - 1 else (i + 1) * band_width)
+            for i in range(band_count)
+        ]
+        self.buckets: list[dict[int, list[tuple[int, object]]]] = [{} for _ in self.bands]
+
+    def _band_keys(self, fingerprint: int):
+        for start, end in self.bands:
+            yield (fingerprint >> start) & ((1 << (end - start)) - 1)
+
+    def add(self, fingerprint: int, ref: object):
+        for bucket, key in zip(self.buckets, self._band_keys(fingerprint)):
+            bucket.setdefault(key, []).append((fingerprint, ref))
+
+    def find(self, fingerprint: int) -> object | None:
+        """Returns the ref of an indexed near-duplicate of `fingerprint`, or None."""
+        for bucket, key in zip(self.buckets, self._band_keys(fingerprint)):
+            for candidate, ref in bucket.get(key, ()):
+                if (candidate ^ fingerprint).bit_count() <= self.max_distance:
+                    return ref
+        return None
@@ -11,19 +11,29 @@ REGION=us-central1
 SERVICE_NAME=doc-processor
 
 
+EMBEDDING_PROVIDER=${EMBEDDING_PROVIDER:-vertex}
+IMAGE_NAME="$REGION-docker.pkg.dev/$GCP_PROJECT_ID/cloud-run-source-deploy/$SERVICE_NAME"
+TAG=$(date +%Y%m%d-%H%M%S)
+
+# Build with Cloud Build so EMBEDDING_PROVIDER can be passed as a build arg;
+# the local provider's runtime and model are only baked into the image when it is "local".
+echo "Building image ${IMAGE_NAME}:${TAG} (embedding provider: $EMBEDDING_PROVIDER)..."
+gcloud builds submit . \
+  --config=cloudbuild.yaml \
+  --substitutions=_SERVICE_NAME=$SERVICE_NAME,_TAG=$TAG,_EMBEDDING_PROVIDER=$EMBEDDING_PROVIDER
+
 # Deploy to Cloud Run
 echo "Deploying service: $SERVICE_NAME to $REGION..."
 
-# This single command builds your code using the Dockerfile and deploys it to Cloud Run.
-# It's a simpler alternative to 'gcloud builds submit'.
 gcloud run deploy "$SERVICE_NAME" \
-  --source . \
+  --image="${IMAGE_NAME}:${TAG}" \
   --region="$REGION" \
   --no-allow-unauthenticated \
-  --set-env-vars="GCP_PROJECT_ID=$GCP_PROJECT_ID,GCP_REGION=$REGION,NEON_DATABASE_URL=$NEON_DATABASE_URL" \
+  --set-env-vars="GCP_PROJECT_ID=$GCP_PROJECT_ID,GCP_REGION=$REGION,NEON_DATABASE_URL=$NEON_DATABASE_URL,EMBEDDING_PROVIDER=$EMBEDDING_PROVIDER" \
   --memory=2Gi \
   --cpu=2 \
-  --timeout=600
+  --timeout=600 \
+  --cpu-boost
 
 echo "✅ Deployment of $SERVICE_NAME successful."
 
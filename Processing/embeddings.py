@@ -0,0 +1,196 @@
+import os
+import json
+import logging
+import threading
+
+from startup import initialize_once
+
+logger = logging.getLogger(__name__)
+
+# "vertex" (default) or "local". Both services must use the same provider,
+# otherwise queries are embedded with a model no stored chunk was embedded with.
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "vertex")
+
+GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
+GCP_REGION = os.getenv("GCP_REGION")
+
+VERTEX_EMBEDDING_MODEL = "text-embedding-005"
+
+# all-mpnet-base-v2 produces 768-dim vectors, the same width as text-embedding-005,
+# so the existing `chunks.embedding` column can hold either. The Dockerfile downloads the
+# model into LOCAL_EMBEDDING_MODEL_DIR at build time when built with EMBEDDING_PROVIDER=local.
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-mpnet-base-v2")
+LOCAL_EMBEDDING_ONNX_FILE = os.getenv("LOCAL_EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+LOCAL_EMBEDDING_MODEL_DIR = os.getenv("LOCAL_EMBEDDING_MODEL_DIR", "/opt/embedding-model")
+LOCAL_EMBEDDING_MAX_TOKENS = int(os.getenv("LOCAL_EMBEDDING_MAX_TOKENS", "384"))
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+# Threads ONNX Runtime uses inside each call.
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS", str(os.cpu_count() or 1)))
+
+
+class EmbeddingProvider:
+    """Common interface for the models that turn text into vectors.
+
+    `model_name` is stored with every chunk so that vectors from different
+    models are never compared against each other.
+    """
+    model_name: str
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Returns exactly one vector per text, in the same order."""
+        raise NotImplementedError
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+class VertexEmbeddingProvider(EmbeddingProvider):
+    model_name = VERTEX_EMBEDDING_MODEL
+
+    TOKEN_LIMIT = 18500
+    # text-embedding-005 reads at most this many tokens of each text.
+    MAX_INPUT_TOKENS = 2048
+
+    def __init__(self):
+        import vertexai
+        from vertexai.language_models import TextEmbeddingModel
+        vertexai.init(project=GCP_PROJECT_ID, location=GCP_REGION)
+        self.model = TextEmbeddingModel.from_pretrained(VERTEX_EMBEDDING_MODEL)
+
+    def embed_query(self, text: str) -> list[float]:
+        # A single query never comes near the batch limit, so skip the token count call.
+        embeddings = self.model.get_embeddings([text])
+        return embeddings[0].values
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        all_embeddings = []
+        batch_for_embedding = []
+        current_batch_tokens = 0
+
+        for text in texts:
+            # 1. Make a quick, free API call to get the exact token count for the current chunk.
+            token_count_response = self.model.count_tokens([text])
+            text_token_count = token_count_response.total_tokens
+
+            # Safety Check: The model ignores everything past its input limit, so cut an oversized
+            # chunk down instead of skipping it. Callers pair vectors with texts by position.
+            if text_token_count > self.MAX_INPUT_TOKENS:
+                logger.warning(
+                    f"Truncating a chunk because its token count ({text_token_count}) "
+                    f"exceeds the model's input limit of {self.MAX_INPUT_TOKENS}."
+                )
+                text = text[:len(text) * self.MAX_INPUT_TOKENS // text_token_count]
+                text_token_count = self.MAX_INPUT_TOKENS
+
+            # 2. If adding this chunk would make the batch too big,
+            #    process the current batch first.
+            if current_batch_tokens + text_token_count > self.TOKEN_LIMIT and batch_for_embedding:
+                logger.info(
+                    f"Token limit reached ({current_batch_tokens} + {text_token_count}). "
+                    f"Processing batch of {len(batch_for_embedding)} chunks..."
+                )
+                response = self.model.get_embeddings(batch_for_embedding)
+                all_embeddings.extend([r.values for r in response])
+
+                # Reset for the next batch
+                batch_for_embedding = []
+                current_batch_tokens = 0
+
+            # 3. Add the current chunk and its token count to the batch.
+            batch_for_embedding.append(text)
+            current_batch_tokens += text_token_count
+
+        # 4. Process the final batch after the loop has finished.
+        if batch_for_embedding:
+            logger.info(f"Processing final batch of {len(batch_for_embedding)} chunks.")
+            response = self.model.get_embeddings(batch_for_embedding)
+            all_embeddings.extend([r.values for r in response])
+
+        return all_embeddings
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """Runs a quantized ONNX sentence-transformer on the instance's CPUs.
+
+    Needs the packages in requirements-local.txt and the model files baked into the image.
+    One ONNX Runtime session already spreads each batch over LOCAL_EMBEDDING_THREADS cores,
+    so batches run one after another, and a lock keeps concurrent requests from sharing
+    the tokenizer or oversubscribing the CPU.
+    """
+
+    def __init__(self):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.model_name = LOCAL_EMBEDDING_MODEL
+        onnx_path = os.path.join(LOCAL_EMBEDDING_MODEL_DIR, LOCAL_EMBEDDING_ONNX_FILE)
+        if not os.path.exists(onnx_path):
+            raise FileNotFoundError(
+                f"Local embedding model not found at {onnx_path}. "
+                f"Build the image with EMBEDDING_PROVIDER=local to download it."
+            )
+
+        with open(os.path.join(LOCAL_EMBEDDING_MODEL_DIR, "tokenizer_config.json")) as f:
+            pad_token = json.load(f).get("pad_token", "[PAD]")
+        if isinstance(pad_token, dict):
+            pad_token = pad_token["content"]
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(LOCAL_EMBEDDING_MODEL_DIR, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=LOCAL_EMBEDDING_MAX_TOKENS)
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token), pad_token=pad_token)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = LOCAL_EMBEDDING_THREADS
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.lock = threading.Lock()
+
+    def _encode_batch(self, batch: list[str]) -> list[list[float]]:
+        import numpy as np
+
+        encodings = self.tokenizer.encode_batch(batch)
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        token_embeddings = self.session.run(None, {k: v for k, v in inputs.items() if k in self.input_names})[0]
+
+        # Mean pooling over real tokens followed by L2 normalization, as sentence-transformers does.
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        with self.lock:
+            for i in range(0, len(texts), LOCAL_EMBEDDING_BATCH_SIZE):
+                vectors.extend(self._encode_batch(texts[i:i + LOCAL_EMBEDDING_BATCH_SIZE]))
+        return vectors
+
+
+_PROVIDERS = {
+    "vertex": VertexEmbeddingProvider,
+    "local": LocalEmbeddingProvider,
+}
+
+# The heavy modules each provider imports, so warm-up can time them one by one.
+PROVIDER_MODULES = {
+    "vertex": ["vertexai", "vertexai.language_models"],
+    "local": ["numpy", "onnxruntime", "tokenizers"],
+}.get(EMBEDDING_PROVIDER, [])
+
+@initialize_once
+def get_embedding_provider() -> EmbeddingProvider:
+    """Returns the configured provider, loading its model on first use."""
+    if EMBEDDING_PROVIDER not in _PROVIDERS:
+        raise ValueError(
+            f"Unknown EMBEDDING_PROVIDER '{EMBEDDING_PROVIDER}'. "
+            f"Expected one of: {', '.join(_PROVIDERS)}."
+        )
+    logger.info(f"Loading '{EMBEDDING_PROVIDER}' embedding provider.")
+    provider = _PROVIDERS[EMBEDDING_PROVIDER]()
+    logger.info(f"Embedding provider ready, model: {provider.model_name}")
+    return provider
@@ -1,3 +1,5 @@
+from startup import deferred_import, initialize_once, start_warm_up
+
 import os
 import json
 import logging
@@ -6,95 +8,71 @@ from tempfile import NamedTemporaryFile
 import hashlib
 
 from fastapi import FastAPI, Request, HTTPException, Response
-from google.cloud import storage
-import vertexai
-from vertexai.language_models import TextEmbeddingModel
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from unstructured.partition.auto import partition
 import sqlalchemy
-import pg8000.dbapi
+
+from embeddings import PROVIDER_MODULES, get_embedding_provider
+from dedup import NEAR_DUPLICATE_MODE, NearDuplicateIndex, simhash, to_signed, to_unsigned
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
-GCP_REGION = os.getenv("GCP_REGION")
-
 NEON_DATABASE_URL = os.getenv("NEON_DATABASE_URL")
 
 
 app = FastAPI()
-storage_client = storage.Client()
-vertexai.init(project=GCP_PROJECT_ID, location=GCP_REGION)
 
 if not NEON_DATABASE_URL:
     raise ValueError("NEON_DATABASE_URL environment variable is not set.")
 
-db_pool = sqlalchemy.create_engine(
-    NEON_DATABASE_URL, 
-    pool_size=5,
-    pool_recycle=1800,
-    pool_pre_ping=True,
-    pool_timeout=30
-)
-logger.info("Database pool for Neon initialized.")
+# google-cloud-storage, unstructured, langchain and vertexai take seconds to import,
+# so they are loaded on first use (or by the warm-up thread) instead of at import time.
+@initialize_once
+def get_storage_client():
+    from google.cloud import storage
+    return storage.Client()
 
-def get_vertex_embeddings(texts: list[str]) -> list[list[float]]:
-    if not texts:
-        return []
-    logger.info(f"Generating embeddings for {len(texts)} texts")
-    model = TextEmbeddingModel.from_pretrained("text-embedding-005")
-    all_embeddings = []
+@initialize_once
+def get_db_pool() -> sqlalchemy.engine.Engine:
+    db_pool = sqlalchemy.create_engine(
+        NEON_DATABASE_URL, 
+        pool_size=5,
+        pool_recycle=1800,
+        pool_pre_ping=True,
+        pool_timeout=30
+    )
+    logger.info("Database pool for Neon initialized.")
+    return db_pool
 
-    TOKEN_LIMIT = 18500
-    
-    batch_for_embedding = []
-    current_batch_tokens = 0
-    
-    for text in texts:
-        # 1. Make a quick, free API call to get the exact token count for the current chunk.
-        token_count_response = model.count_tokens([text])
-        text_token_count = token_count_response.total_tokens
-
-        # Safety Check: If a single chunk is larger than the limit, skip it.
-        if text_token_count > TOKEN_LIMIT:
-            logger.warning(
-                f"Skipping a chunk because its token count ({text_token_count}) "
-                f"exceeds the limit of {TOKEN_LIMIT}."
-            )
-            continue
-
-        # 2. If adding this chunk would make the batch too big,
-        #    process the current batch first.
-        if current_batch_tokens + text_token_count > TOKEN_LIMIT and batch_for_embedding:
-            logger.info(
-                f"Token limit reached ({current_batch_tokens} + {text_token_count}). "
-                f"Processing batch of {len(batch_for_embedding)} chunks..."
-            )
-            response = model.get_embeddings(batch_for_embedding)
-            all_embeddings.extend([r.values for r in response])
-            
-            # Reset for the next batch
-            batch_for_embedding = []
-            current_batch_tokens = 0
-
-        # 3. Add the current chunk and its token count to the batch.
-        batch_for_embedding.append(text)
-        current_batch_tokens += text_token_count
-    
-    # 4. Process the final batch after the loop has finished.
-    if batch_for_embedding:
-        logger.info(f"Processing final batch of {len(batch_for_embedding)} chunks.")
-        response = model.get_embeddings(batch_for_embedding)
-        all_embeddings.extend([r.values for r in response])
+@app.on_event("startup")
+def warm_up():
+    start_warm_up({
+        "import google.cloud.storage": deferred_import("google.cloud.storage"),
+        "import unstructured.partition.auto": deferred_import("unstructured.partition.auto"),
+        "import langchain.text_splitter": deferred_import("langchain.text_splitter"),
+        **{f"import {module}": deferred_import(module) for module in PROVIDER_MODULES},
+        "storage_client": get_storage_client,
+        "db_pool": get_db_pool,
+        "db_connection": lambda: get_db_pool().connect().close(),
+        "embedding_provider": get_embedding_provider,
+    })
 
+def get_embeddings(texts: list[str]) -> tuple[list[list[float]], str]:
+    """Embeds the chunks with the configured provider and returns the vectors with the model name."""
+    provider = get_embedding_provider()
+    if not texts:
+        return [], provider.model_name
+    logger.info(f"Generating embeddings for {len(texts)} texts with {provider.model_name}")
+    all_embeddings = provider.embed_documents(texts)
     logger.info("Embeddings generated successfully")
-    return all_embeddings
+    return all_embeddings, provider.model_name
 
 def download_chunk_and_hash(bucket_name: str, file_name: str) -> tuple[list[str], str]:
 
     logger.info(f"Downloading and chunking {file_name} from bucket {bucket_name}")
-    bucket = storage_client.bucket(bucket_name)
+    from unstructured.partition.auto import partition
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(file_name)
 
     file_content = blob.download_as_bytes()
@@ -116,11 +94,70 @@ def download_chunk_and_hash(bucket_name: str, file_name: str) -> tuple[list[str]
     logger.info(f"Content split into {len(chunks)} chunks")
     return chunks, file_hash
 
-def update_document_and_insert_chunks(doc_id: int, metadata: dict, chunks: list[str], embeddings: list[list[float]]):
+def filter_near_duplicates(doc_id: int, chunks: list[str]) -> tuple[list[dict], list[dict]]:
+    """Splits a document's chunks into ones that need embedding and near-duplicates of other chunks.
+
+    Chunks are compared against each other and against the owner's other documents.
+    Returns (unique_chunks, linked_chunks). A linked chunk points at the chunk it repeats,
+    either an existing chunk id in `duplicate_of` or, for a repeat within this document,
+    the position of a unique chunk in `duplicate_of_unique`. Linked chunks are only
+    returned when NEAR_DUPLICATE_MODE is "link"; in "skip" mode they are dropped.
+    """
+    fingerprints = [simhash(text) for text in chunks]
+    if NEAR_DUPLICATE_MODE == "off":
+        return [{"chunk_text": text, "simhash": fingerprint} for text, fingerprint in zip(chunks, fingerprints)], []
+
+    index = NearDuplicateIndex()
+    with get_db_pool().connect() as conn:
+        # Only primary chunks embedded by the same model are link targets, so links never chain.
+        # Chunks of archived documents or documents being deleted don't count, since they are hidden from search.
+        stmt = sqlalchemy.text("""
+            SELECT c.id, c.simhash
+            FROM chunks AS c
+            JOIN documents AS d ON c.document_id = d.id
+            WHERE d.user_id = (SELECT user_id FROM documents WHERE id = :doc_id)
+                AND d.id <> :doc_id
+                AND d.is_archived = FALSE
+                AND d.processing_status <> 'DELETING'
+                AND c.simhash IS NOT NULL
+                AND c.duplicate_of IS NULL
+                AND c.embedding_model = :embedding_model;
+        """)
+        result = conn.execute(stmt, {"doc_id": doc_id, "embedding_model": get_embedding_provider().model_name})
+        for chunk_id, fingerprint in result:
+            index.add(to_unsigned(fingerprint), ("existing", chunk_id))
+
+    unique_chunks, linked_chunks = [], []
+    skipped_count = 0
+    for text, fingerprint in zip(chunks, fingerprints):
+        match = index.find(fingerprint)
+        if match is None:
+            index.add(fingerprint, ("unique", len(unique_chunks)))
+            unique_chunks.append({"chunk_text": text, "simhash": fingerprint})
+        elif NEAR_DUPLICATE_MODE == "link":
+            kind, target = match
+            linked_chunks.append({
+                "chunk_text": text,
+                "simhash": fingerprint,
+                "duplicate_of": target if kind == "existing" else None,
+                "duplicate_of_unique": target if kind == "unique" else None,
+            })
+        else:
+            skipped_count += 1
+
+    logger.info(
+        f"Near-duplicate check for doc_id {doc_id}: {len(unique_chunks)} unique, "
+        f"{len(linked_chunks)} linked, {skipped_count} skipped"
+    )
+    return unique_chunks, linked_chunks
+
+def update_document_and_insert_chunks(doc_id: int, metadata: dict, chunks: list[dict], embeddings: list[list[float]], embedding_model: str, linked_chunks: list[dict]):
     """Finds the placeholder record by hash and updates it with the processed data."""
     logger.info(f"Updating database record for document with doc_id = {doc_id}")
+    if len(embeddings) != len(chunks):
+        raise ValueError(f"Got {len(embeddings)} embeddings for {len(chunks)} chunks of doc_id {doc_id}.")
     
-    with db_pool.connect() as conn:
+    with get_db_pool().connect() as conn:
         with conn.begin() as transaction:
             try:
                 
@@ -131,31 +168,83 @@ def update_document_and_insert_chunks(doc_id: int, metadata: dict, chunks: list[
                         file_hash = :file_hash,
                         processing_status = 'COMPLETED',
                         updated_at = NOW()
-                    WHERE id = :doc_id;
+                    WHERE id = :doc_id AND processing_status <> 'DELETING';
                 """)
                 result = conn.execute(update_stmt, {**metadata, "doc_id": doc_id})
                 if result.rowcount == 0:
-                    logger.error(f"FATAL: Document with ID {doc_id} not found. Cannot update.")
+                    logger.error(f"FATAL: Document with ID {doc_id} not found or being deleted. Cannot update.")
                     transaction.rollback() 
                     return
                 # Delete any old chunks for this document before inserting new ones
                 conn.execute(sqlalchemy.text("DELETE FROM chunks WHERE document_id = :doc_id"), {"doc_id": doc_id})
 
-                # Insert the new chunks
-                if chunks and embeddings:
-                    chunk_data = [
+                # Lock the existing chunks the links point at, so they can't be deleted before this commits.
+                # Targets deleted since filter_near_duplicates read them lose their links; those
+                # chunks are embedded now and stored as unique chunks instead.
+                orphaned_chunks, orphaned_embeddings = [], []
+                target_ids = list({chunk["duplicate_of"] for chunk in linked_chunks if chunk["duplicate_of"] is not None})
+                if target_ids:
+                    lock_stmt = sqlalchemy.text("SELECT id FROM chunks WHERE id = ANY(:target_ids) FOR KEY SHARE;")
+                    live_target_ids = set(conn.execute(lock_stmt, {"target_ids": target_ids}).scalars())
+                    orphaned_chunks = [
+                        chunk for chunk in linked_chunks
+                        if chunk["duplicate_of"] is not None and chunk["duplicate_of"] not in live_target_ids
+                    ]
+                    if orphaned_chunks:
+                        logger.warning(f"{len(orphaned_chunks)} link targets of doc_id {doc_id} were deleted; embedding those chunks.")
+                        linked_chunks = [
+                            chunk for chunk in linked_chunks
+                            if chunk["duplicate_of"] is None or chunk["duplicate_of"] in live_target_ids
+                        ]
+                        orphaned_embeddings, orphaned_model = get_embeddings([chunk["chunk_text"] for chunk in orphaned_chunks])
+                        if len(orphaned_embeddings) != len(orphaned_chunks) or orphaned_model != embedding_model:
+                            raise ValueError(f"Could not embed the unlinked chunks of doc_id {doc_id} with {embedding_model}.")
+
+                # Insert the unique chunks in one statement and get their ids back for the links below.
+                unique_chunk_ids = []
+                if chunks or orphaned_chunks:
+                    chunk_insert_stmt = sqlalchemy.text("""
+                        INSERT INTO chunks (document_id, chunk_text, embedding, embedding_model, simhash)
+                        SELECT :document_id, t.chunk_text, CAST(t.embedding AS vector), :embedding_model, t.simhash
+                        FROM unnest(CAST(:chunk_texts AS text[]), CAST(:embeddings AS text[]), CAST(:simhashes AS bigint[]))
+                            AS t(chunk_text, embedding, simhash)
+                        RETURNING id, simhash;
+                    """)
+                    all_chunks = chunks + orphaned_chunks
+                    result = conn.execute(chunk_insert_stmt, {
+                        "document_id": doc_id,
+                        "embedding_model": embedding_model,
+                        "chunk_texts": [chunk["chunk_text"] for chunk in all_chunks],
+                        "embeddings": [f"[{','.join(map(str, embedding))}]" for embedding in embeddings + orphaned_embeddings],
+                        "simhashes": [to_signed(chunk["simhash"]) for chunk in all_chunks],
+                    })
+                    # RETURNING order isn't guaranteed, so match rows up by fingerprint. Unique chunks
+                    # can't share one, since an identical fingerprint would have made them near-duplicates.
+                    id_by_simhash = {simhash: chunk_id for chunk_id, simhash in result}
+                    unique_chunk_ids = [id_by_simhash[to_signed(chunk["simhash"])] for chunk in chunks]
+
+                # Linked near-duplicates carry a copy of their target's vector, so they become searchable
+                # on their own when the target is deleted and `duplicate_of` is set to NULL.
+                if linked_chunks:
+                    linked_insert_stmt = sqlalchemy.text("""
+                        INSERT INTO chunks (document_id, chunk_text, embedding, embedding_model, simhash, duplicate_of)
+                        SELECT :document_id, :chunk_text, t.embedding, :embedding_model, :simhash, t.id
+                        FROM chunks AS t
+                        WHERE t.id = :duplicate_of;
+                    """)
+                    linked_data = [
                         {
                             "document_id": doc_id, 
-                            "chunk_text": text, 
-                            "embedding": f"[{','.join(map(str, embedding))}]"
-                        } for text, embedding in zip(chunks, embeddings)
+                            "chunk_text": chunk["chunk_text"], 
+                            "embedding_model": embedding_model,
+                            "simhash": to_signed(chunk["simhash"]),
+                            "duplicate_of": (
+                                chunk["duplicate_of"] if chunk["duplicate_of_unique"] is None
+                                else unique_chunk_ids[chunk["duplicate_of_unique"]]
+                            )
+                        } for chunk in linked_chunks
                     ]
-                    
-                    chunk_insert_stmt = sqlalchemy.text(
-                        "INSERT INTO chunks (document_id, chunk_text, embedding) VALUES (:document_id, :chunk_text, CAST(:embedding AS vector));"
-                    )
-                    
-                    conn.execute(chunk_insert_stmt, chunk_data)
+                    conn.execute(linked_insert_stmt, linked_data)
                 
                 logger.info(f"Successfully processed and marked document ID {doc_id} as COMPLETED.")
             except Exception as e:
@@ -188,22 +277,23 @@ async def subscriber(request: Request):
         doc_id = int(doc_id_str)
         
         chunks, file_hash = download_chunk_and_hash(data['bucket'], gcs_path)
-        embeddings = get_vertex_embeddings(chunks)
+        unique_chunks, linked_chunks = filter_near_duplicates(doc_id, chunks)
+        embeddings, embedding_model = get_embeddings([chunk["chunk_text"] for chunk in unique_chunks])
 
         doc_metadata = {
             "file_size_bytes": data.get("size", 0),
             "file_hash": file_hash,
-            "chunk_count": len(chunks)
+            "chunk_count": len(unique_chunks) + len(linked_chunks)
         }
-        update_document_and_insert_chunks(doc_id, doc_metadata, chunks, embeddings)
+        update_document_and_insert_chunks(doc_id, doc_metadata, unique_chunks, embeddings, embedding_model, linked_chunks)
 
         return Response(status_code=200)
     except Exception as e:
         logger.exception(f"Critical error processing message for doc_id {doc_id}: {e}")
         if doc_id:
             try:
-                with db_pool.connect() as conn:
-                    error_update_stmt = sqlalchemy.text("UPDATE documents SET processing_status = 'FAILED', error_message = :error WHERE id = :doc_id;")
+                with get_db_pool().connect() as conn:
+                    error_update_stmt = sqlalchemy.text("UPDATE documents SET processing_status = 'FAILED', error_message = :error WHERE id = :doc_id AND processing_status <> 'DELETING';")
                     conn.execute(error_update_stmt, {"doc_id": doc_id, "error": str(e)})
                     conn.commit() # Explicitly commit the failure state
             except Exception as db_err:
@@ -0,0 +1,74 @@
+import os
+import time
+import logging
+import threading
+import functools
+import importlib
+from typing import Callable, TypeVar
+
+T = TypeVar("T")
+
+# Imported first by main.py so this marks the start of the service's own imports.
+IMPORT_STARTED_AT = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+# "lazy" (default): open the port straight away and build heavy clients in a
+# background thread. "eager": build everything before serving the first request.
+# For a full per-module import tree, also set PYTHONPROFILEIMPORTTIME=1 on the service.
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
+
+
+def initialize_once(factory: Callable[[], T]) -> Callable[[], T]:
+    """Turns a zero-argument factory into a getter that builds its result on first call.
+
+    The lock makes sure a request and the warm-up thread never build the same client twice.
+    A factory that raises is retried on the next call.
+    """
+    lock = threading.Lock()
+    instance = []
+
+    @functools.wraps(factory)
+    def getter() -> T:
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    return getter
+
+
+def deferred_import(module_name: str) -> Callable[[], object]:
+    """Returns a warm-up step that imports `module_name`, so its import time is reported on its own."""
+    return lambda: importlib.import_module(module_name)
+
+
+def _run_warm_up(steps: dict[str, Callable[[], object]]):
+    timings = {}
+    for name, step in steps.items():
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            # Not fatal: the same initializer runs again on first use and reports the error there.
+            logger.error(f"Warm-up step '{name}' failed.", exc_info=True)
+        timings[name] = time.perf_counter() - started
+        logger.info(f"Warm-up step '{name}' took {timings[name]:.3f}s")
+
+    logger.info(f"Warm-up finished in {sum(timings.values()):.2f}s; slowest steps first:")
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        logger.info(f"  {seconds:7.3f}s  {name}")
+
+
+def start_warm_up(steps: dict[str, Callable[[], object]]):
+    """Reports how long the service took to import and runs the warm-up steps.
+
+    Every step must be safe to call concurrently with a request that needs the
+    same resource, i.e. one of the lazy getters that initialize under a lock.
+    """
+    logger.info(f"Service modules imported in {time.perf_counter() - IMPORT_STARTED_AT:.2f}s (mode: {STARTUP_MODE})")
+    if STARTUP_MODE == "eager":
+        _run_warm_up(steps)
+    else:
+        threading.Thread(target=_run_warm_up, args=(steps,), name="warm-up", daemon=True).start()
@@ -1,15 +1,22 @@
 import os  # <-- Add this import
-import firebase_admin
-from firebase_admin import credentials, auth
 from fastapi import Request, HTTPException, Depends
 
+from startup import initialize_once
+
 PROJECT_ID = os.getenv("GCP_PROJECT_ID")
 FIREBASE_SA_KEY_PATH = "/secrets/firebase-key/sa.json"
 
-if not firebase_admin._apps:
-    if os.path.exists(FIREBASE_SA_KEY_PATH):
-        cred = credentials.Certificate(FIREBASE_SA_KEY_PATH)
-        firebase_admin.initialize_app(cred)
+@initialize_once
+def get_firebase_auth():
+    """Imports and initializes firebase_admin on first use and returns its auth module."""
+    import firebase_admin
+    from firebase_admin import credentials, auth
+
+    if not firebase_admin._apps:
+        if os.path.exists(FIREBASE_SA_KEY_PATH):
+            cred = credentials.Certificate(FIREBASE_SA_KEY_PATH)
+            firebase_admin.initialize_app(cred)
+    return auth
 
 async def verify_token(request: Request):
     """Verifies a Firebase ID token from the Authorization header."""
@@ -19,7 +26,7 @@ async def verify_token(request: Request):
         
     try:
         id_token = auth_header.split(" ")[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = get_firebase_auth().verify_id_token(id_token)
         return decoded_token
     except Exception as e:
         print(f"Token verification failed: {e}")
@@ -1,40 +1,47 @@
 import os
 import logging
 import sqlalchemy
-import vertexai
-from vertexai.language_models import TextEmbeddingModel
+import numpy as np
+
+from embeddings import get_embedding_provider
+from startup import initialize_once
+from ranking import MMR_FETCH_MULTIPLIER, mmr_select, parse_vector
 
 logger = logging.getLogger(__name__)
 
+class DocumentBeingDeletedError(Exception):
+    """Raised when an upload collides with a copy of the same file that is still being deleted."""
+
 # Get the full database URL from environment variables, provided by Cloud Run
 NEON_DATABASE_URL = os.getenv("NEON_DATABASE_URL")
-GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
-GCP_REGION = os.getenv("GCP_REGION")
 
-if GCP_PROJECT_ID and GCP_REGION:
-    vertexai.init(project=GCP_PROJECT_ID, location=GCP_REGION)
+CHUNK_DELETE_BATCH_SIZE = int(os.getenv("CHUNK_DELETE_BATCH_SIZE", "1000"))
 
 if not NEON_DATABASE_URL:
     raise ValueError("NEON_DATABASE_URL environment variable is not set.")
 
-db_pool = sqlalchemy.create_engine(
-    NEON_DATABASE_URL,
-    pool_size=5,
-    pool_recycle=1800,
-    pool_pre_ping=True
-)
-logger.info("Neon database pool initialized.")
+@initialize_once
+def get_db_pool() -> sqlalchemy.engine.Engine:
+    db_pool = sqlalchemy.create_engine(
+        NEON_DATABASE_URL,
+        pool_size=5,
+        pool_recycle=1800,
+        pool_pre_ping=True
+    )
+    logger.info("Neon database pool initialized.")
+    return db_pool
 
-def get_vertex_embedding(text: str) -> list[float]:
+def get_query_embedding(text: str) -> tuple[list[float], str]:
+    """Embeds a search query and returns the vector with the name of the model that produced it."""
     logger.info("Generating embedding for query...")
-    model = TextEmbeddingModel.from_pretrained("text-embedding-005")
-    embeddings = model.get_embeddings([text])
+    provider = get_embedding_provider()
+    embedding = provider.embed_query(text)
     logger.info("Embedding generated.")
-    return embeddings[0].values
+    return embedding, provider.model_name
 
 def list_user_documents(user_id: str) -> list[dict]:
     logger.info(f"Listing documents for user: {user_id}")
-    with db_pool.connect() as conn:
+    with get_db_pool().connect() as conn:
         # The only change is adding "gcs_path" to the SELECT list.
         stmt = sqlalchemy.text("""
             SELECT id, gcs_path, display_name, filename, content_type, created_at, file_size_bytes
@@ -47,11 +54,15 @@ def list_user_documents(user_id: str) -> list[dict]:
     return documents
 
 def query_vector_store(user_id: str, query_text: str, top_k: int = 10) -> list[dict]:
-    """Performs a semantic search for a user's query."""
+    """Performs a semantic search for a user's query.
+
+    Over-fetches the nearest chunks and re-ranks them with MMR so that near-identical
+    chunks don't crowd the other results out of the top_k.
+    """
     logger.info(f"Executing vector query for user: {user_id}")
-    query_embedding = get_vertex_embedding(query_text)
+    query_embedding, embedding_model = get_query_embedding(query_text)
     embedding_str = "[" + ",".join(map(str, query_embedding)) + "]"
-    with db_pool.connect() as conn:
+    with get_db_pool().connect() as conn:
         stmt = sqlalchemy.text("""
             SELECT
                 d.id,
@@ -62,12 +73,20 @@ def query_vector_store(user_id: str, query_text: str, top_k: int = 10) -> list[d
                 d.created_at,
                 d.file_size_bytes,
                 c.chunk_text AS snippet,
-                1 - (c.embedding <=> :query_embedding) AS score
+                1 - (c.embedding <=> :query_embedding) AS score,
+                c.embedding::text AS embedding
             FROM chunks AS c
             JOIN documents AS d ON c.document_id = d.id
             WHERE d.user_id = :user_id AND d.is_archived = FALSE
+                AND c.embedding_model = :embedding_model
+                AND (c.duplicate_of IS NULL OR NOT EXISTS (
+                    -- A linked near-duplicate stands in for its target while the target's document is hidden.
+                    SELECT 1 FROM chunks AS t
+                    JOIN documents AS td ON t.document_id = td.id
+                    WHERE t.id = c.duplicate_of AND td.is_archived = FALSE
+                ))
             ORDER BY c.embedding <=> :query_embedding
-            LIMIT :top_k;
+            LIMIT :fetch_k;
         """)
         
         result = conn.execute(
@@ -75,16 +94,23 @@ def query_vector_store(user_id: str, query_text: str, top_k: int = 10) -> list[d
             parameters={
                 "query_embedding": embedding_str,
                 "user_id": user_id,
-                "top_k": top_k,
+                "embedding_model": embedding_model,
+                "fetch_k": top_k * MMR_FETCH_MULTIPLIER,
             }
         )
-        matches = [row._asdict() for row in result]
+        candidates = [row._asdict() for row in result]
+
+    if not candidates:
+        return []
+    relevance = np.array([candidate["score"] for candidate in candidates], dtype=np.float32)
+    embeddings = np.stack([parse_vector(candidate.pop("embedding")) for candidate in candidates])
+    matches = [candidates[i] for i in mmr_select(relevance, embeddings, top_k)]
     return matches
 
 def check_for_duplicate(user_id: str, file_hash: str) -> bool:
     """Checks if a file with the same hash already exists for a user."""
     logger.info(f"Checking for duplicate file hash for user: {user_id}")
-    with db_pool.connect() as conn:
+    with get_db_pool().connect() as conn:
         stmt = sqlalchemy.text("""
             SELECT EXISTS (
                 SELECT 1 FROM documents WHERE user_id = :user_id AND file_hash = :file_hash
@@ -96,7 +122,7 @@ def check_for_duplicate(user_id: str, file_hash: str) -> bool:
 def get_user_stats(user_id: str) -> dict:
     """Calculates aggregate stats for a user's documents."""
     logger.info(f"Fetching stats for user: {user_id}")
-    with db_pool.connect() as conn:
+    with get_db_pool().connect() as conn:
         stmt = sqlalchemy.text("""
             SELECT
                 COUNT(*) AS document_count,
@@ -111,7 +137,7 @@ def get_user_stats(user_id: str) -> dict:
         
 #updated to use doc id
 def get_document_status_by_id(user_id: str, doc_id: int) -> str | None:
-    with db_pool.connect() as conn:
+    with get_db_pool().connect() as conn:
         stmt = sqlalchemy.text("""
             SELECT processing_status FROM documents
             WHERE user_id = :user_id AND id = :doc_id;
@@ -128,7 +154,7 @@ def create_upload_record(user_id: str, filename: str, filetype: str, file_hash:
     # 1. Construct the clean, final GCS path.
     gcs_path = f"{user_id}/{filename}"
 
-    with db_pool.connect() as conn:
+    with get_db_pool().connect() as conn:
         # Use a transaction to ensure all database operations succeed or fail together.
         with conn.begin() as transaction:
             
@@ -156,6 +182,7 @@ def create_upload_record(user_id: str, filename: str, filetype: str, file_hash:
                     chunk_count = NULL,
                     error_message = NULL,
                     updated_at = NOW()
+                WHERE documents.processing_status <> 'DELETING'
                 RETURNING id, gcs_path;
             """)
             
@@ -169,13 +196,17 @@ def create_upload_record(user_id: str, filename: str, filetype: str, file_hash:
             })
             
             # Ensure we get the definitive path back from the database.
-            doc_id, gcs_path = result.first()
+            row = result.first()
+            if row is None:
+                # The upsert's WHERE skipped an existing copy of this file that is being deleted.
+                raise DocumentBeingDeletedError(f"A copy of file hash {file_hash} is still being deleted for user {user_id}.")
+            doc_id, gcs_path = row
     # 4. Return the path to the calling function in main.py
     return doc_id, gcs_path
 
 def get_gcs_path_by_doc_id(uid: str, doc_id: int) -> str | None:
     logger.info(f"Fetching GCS path for user {uid}, document ID {doc_id}")
-    with db_pool.connect() as conn:
+    with get_db_pool().connect() as conn:
         stmt = sqlalchemy.text("""
             SELECT gcs_path FROM documents
             WHERE user_id = :user_id AND id = :doc_id;
@@ -184,33 +215,140 @@ def get_gcs_path_by_doc_id(uid: str, doc_id: int) -> str | None:
         gcs_path = result.scalar_one_or_none()
     return gcs_path
 
-def delete_document_records(doc_id: int):
-    logger.info(f"Attempting to delete all database records for doc_id: {doc_id}")
-    with db_pool.connect() as conn:
-        with conn.begin() as transaction: 
+def mark_documents_deleting(user_id: str, doc_ids: list[int]) -> dict[int, str]:
+    """Hides the user's documents from listings and search before they are deleted.
+
+    Returns {doc_id: gcs_path} for the ids that exist and belong to the user.
+    """
+    logger.info(f"Marking {len(doc_ids)} documents as DELETING for user {user_id}")
+    with get_db_pool().connect() as conn:
+        stmt = sqlalchemy.text("""
+            UPDATE documents SET
+                is_archived = TRUE,
+                processing_status = 'DELETING',
+                updated_at = NOW()
+            WHERE user_id = :user_id AND id = ANY(:doc_ids)
+            RETURNING id, gcs_path;
+        """)
+        result = conn.execute(stmt, parameters={"user_id": user_id, "doc_ids": doc_ids})
+        documents = {doc_id: gcs_path for doc_id, gcs_path in result}
+        conn.commit()
+    return documents
+
+def delete_document_records(doc_ids: list[int]) -> list[str]:
+    """Deletes the documents and their chunks.
+
+    Chunks go in batches of CHUNK_DELETE_BATCH_SIZE, each in its own short transaction,
+    so a large library never holds locks on `chunks` for long. A run that dies halfway
+    leaves the documents marked DELETING for the reconciler to finish.
+    Returns the GCS paths that no remaining document refers to.
+    """
+    logger.info(f"Attempting to delete all database records for doc_ids: {doc_ids}")
+    delete_chunks_stmt = sqlalchemy.text("""
+        DELETE FROM chunks WHERE id IN (
+            SELECT id FROM chunks WHERE document_id = ANY(:doc_ids) LIMIT :batch_size
+        );
+    """)
+    with get_db_pool().connect() as conn:
+        deleted_chunks = 0
+        while True:
+            with conn.begin():
+                result = conn.execute(delete_chunks_stmt, {"doc_ids": doc_ids, "batch_size": CHUNK_DELETE_BATCH_SIZE})
+            deleted_chunks += result.rowcount
+            if result.rowcount < CHUNK_DELETE_BATCH_SIZE:
+                break
+        logger.info(f"Deleted {deleted_chunks} chunks for doc_ids: {doc_ids}")
+
+        with conn.begin() as transaction:
             try:
-                
-                delete_chunks_stmt = sqlalchemy.text(
-                    "DELETE FROM chunks WHERE document_id = :doc_id"
+                delete_docs_stmt = sqlalchemy.text(
+                    "DELETE FROM documents WHERE id = ANY(:doc_ids) RETURNING gcs_path"
                 )
-                conn.execute(delete_chunks_stmt, {"doc_id": doc_id})
+                gcs_paths = list({row.gcs_path for row in conn.execute(delete_docs_stmt, {"doc_ids": doc_ids})})
 
-               
-                delete_doc_stmt = sqlalchemy.text(
-                    "DELETE FROM documents WHERE id = :doc_id"
-                )
-                result = conn.execute(delete_doc_stmt, {"doc_id": doc_id})
-                
-                
-                if result.rowcount == 0:
-                    raise ValueError(f"No document found with id {doc_id} to delete.")
-                
-                logger.info(f"Successfully deleted database records for doc_id: {doc_id}")
+                # Two uploads of the same filename share a GCS path, so keep objects still in use.
+                still_referenced = set()
+                if gcs_paths:
+                    still_referenced_stmt = sqlalchemy.text(
+                        "SELECT DISTINCT gcs_path FROM documents WHERE gcs_path = ANY(:gcs_paths)"
+                    )
+                    still_referenced = set(conn.execute(still_referenced_stmt, {"gcs_paths": gcs_paths}).scalars())
+
+                logger.info(f"Successfully deleted database records for doc_ids: {doc_ids}")
             except Exception as e:
-               
                 logger.error(
-                    f"Database error while deleting records for doc_id {doc_id}. "
+                    f"Database error while deleting records for doc_ids {doc_ids}. "
                     f"Transaction rolled back.", 
                     exc_info=True
                 )
-                raise
\ No newline at end of file
+                raise
+    return [gcs_path for gcs_path in gcs_paths if gcs_path not in still_referenced]
+
+def list_documents_for_reconcile(grace_minutes: int) -> list[dict]:
+    """Returns id, gcs_path and processing_status of every document untouched for `grace_minutes`."""
+    with get_db_pool().connect() as conn:
+        stmt = sqlalchemy.text("""
+            SELECT id, gcs_path, processing_status FROM documents
+            WHERE updated_at < NOW() - make_interval(mins => :grace_minutes);
+        """)
+        result = conn.execute(stmt, parameters={"grace_minutes": grace_minutes})
+        documents = [row._asdict() for row in result]
+    return documents
+
+def list_referenced_gcs_paths() -> set[str]:
+    with get_db_pool().connect() as conn:
+        result = conn.execute(sqlalchemy.text("SELECT DISTINCT gcs_path FROM documents;"))
+        gcs_paths = set(result.scalars())
+    return gcs_paths
+
+def list_chunks_to_reembed(embedding_model: str, limit: int) -> list[dict]:
+    """Returns primary chunks embedded by a model other than `embedding_model`, which search can't find."""
+    with get_db_pool().connect() as conn:
+        stmt = sqlalchemy.text("""
+            SELECT id, chunk_text FROM chunks
+            WHERE embedding_model <> :embedding_model AND duplicate_of IS NULL
+            ORDER BY id
+            LIMIT :limit;
+        """)
+        result = conn.execute(stmt, parameters={"embedding_model": embedding_model, "limit": limit})
+        chunks = [row._asdict() for row in result]
+    return chunks
+
+def count_chunks_to_reembed(embedding_model: str) -> int:
+    """Counts all chunks, linked ones included, embedded by a model other than `embedding_model`."""
+    with get_db_pool().connect() as conn:
+        stmt = sqlalchemy.text("SELECT COUNT(*) FROM chunks WHERE embedding_model <> :embedding_model;")
+        return conn.execute(stmt, parameters={"embedding_model": embedding_model}).scalar_one()
+
+def update_chunk_embeddings(chunk_ids: list[int], embeddings: list[list[float]], embedding_model: str):
+    with get_db_pool().connect() as conn:
+        with conn.begin():
+            stmt = sqlalchemy.text("""
+                UPDATE chunks SET
+                    embedding = CAST(:embedding AS vector),
+                    embedding_model = :embedding_model
+                WHERE id = :chunk_id;
+            """)
+            conn.execute(stmt, [
+                {
+                    "chunk_id": chunk_id,
+                    "embedding": "[" + ",".join(map(str, embedding)) + "]",
+                    "embedding_model": embedding_model,
+                } for chunk_id, embedding in zip(chunk_ids, embeddings)
+            ])
+
+def copy_linked_chunk_embeddings(embedding_model: str) -> int:
+    """Gives linked chunks still on another model their target's new vector. Returns how many were updated."""
+    with get_db_pool().connect() as conn:
+        stmt = sqlalchemy.text("""
+            UPDATE chunks AS c SET
+                embedding = t.embedding,
+                embedding_model = t.embedding_model
+            FROM chunks AS t
+            WHERE c.duplicate_of = t.id
+                AND c.embedding_model <> :embedding_model
+                AND t.embedding_model = :embedding_model;
+        """)
+        result = conn.execute(stmt, parameters={"embedding_model": embedding_model})
+        conn.commit()
+    return result.rowcount
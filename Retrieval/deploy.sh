@@ -13,20 +13,64 @@ SERVICE_NAME="query-api"
 REGION="us-central1"
 GCP_PROJECT_ID=$(gcloud config get-value project) # Automatically get project ID
 
+EMBEDDING_PROVIDER=${EMBEDDING_PROVIDER:-vertex}
+IMAGE_NAME="$REGION-docker.pkg.dev/$GCP_PROJECT_ID/cloud-run-source-deploy/$SERVICE_NAME"
+TAG=$(date +%Y%m%d-%H%M%S)
+
+# Build with Cloud Build so EMBEDDING_PROVIDER can be passed as a build arg;
+# the local provider's runtime and model are only baked into the image when it is "local".
+echo "Building image ${IMAGE_NAME}:${TAG} (embedding provider: $EMBEDDING_PROVIDER)..."
+gcloud builds submit . \
+  --config=cloudbuild.yaml \
+  --substitutions=_SERVICE_NAME=$SERVICE_NAME,_TAG=$TAG,_EMBEDDING_PROVIDER=$EMBEDDING_PROVIDER
+
 echo "Deploying service: $SERVICE_NAME to $REGION..."
 
-# This single command builds and deploys your service to Cloud Run
 gcloud run deploy "$SERVICE_NAME" \
-  --source . \
+  --image="${IMAGE_NAME}:${TAG}" \
   --region="$REGION" \
   --memory=1Gi \
   --timeout=300 \
   --allow-unauthenticated \
   --cpu=2 \
   --min-instances=1 \
-  --set-env-vars="NEON_DATABASE_URL=$NEON_DATABASE_URL,GCP_PROJECT_ID=$GCP_PROJECT_ID,GCP_REGION=$REGION,GCP_BUCKET_NAME=$GCP_BUCKET_NAME" \
+  --cpu-boost \
+  --set-env-vars="NEON_DATABASE_URL=$NEON_DATABASE_URL,GCP_PROJECT_ID=$GCP_PROJECT_ID,GCP_REGION=$REGION,GCP_BUCKET_NAME=$GCP_BUCKET_NAME,EMBEDDING_PROVIDER=$EMBEDDING_PROVIDER" \
   --set-secrets="/secrets/firebase-key/sa.json=firebase-auth-connection-key:latest,/secrets/gcs-key/sa.json=gcs-signer-key:latest"
 
+# The reconciler removes what the in-memory GCS delete queue loses when an instance is
+# throttled or shut down, so it runs from the same image as a Cloud Run job on a schedule.
+JOB_NAME="${SERVICE_NAME}-reconciler"
+RECONCILE_SCHEDULE=${RECONCILE_SCHEDULE:-"0 * * * *"}
+
+echo "Deploying reconciler job: $JOB_NAME..."
+gcloud run jobs deploy "$JOB_NAME" \
+  --image="${IMAGE_NAME}:${TAG}" \
+  --region="$REGION" \
+  --memory=1Gi \
+  --cpu=2 \
+  --max-retries=0 \
+  --task-timeout=1800 \
+  --command=python \
+  --args=reconcile.py \
+  --set-env-vars="NEON_DATABASE_URL=$NEON_DATABASE_URL,GCP_PROJECT_ID=$GCP_PROJECT_ID,GCP_REGION=$REGION,GCP_BUCKET_NAME=$GCP_BUCKET_NAME,EMBEDDING_PROVIDER=$EMBEDDING_PROVIDER" \
+  --set-secrets="/secrets/gcs-key/sa.json=gcs-signer-key:latest"
+
+PROJECT_NUMBER=$(gcloud projects describe "$GCP_PROJECT_ID" --format="value(projectNumber)")
+SCHEDULER_ARGS=(
+  --location="$REGION"
+  --schedule="$RECONCILE_SCHEDULE"
+  --uri="https://run.googleapis.com/v2/projects/$GCP_PROJECT_ID/locations/$REGION/jobs/$JOB_NAME:run"
+  --http-method=POST
+  --oauth-service-account-email="$PROJECT_NUMBER-compute@developer.gserviceaccount.com"
+)
+if gcloud scheduler jobs describe "$JOB_NAME" --location="$REGION" >/dev/null 2>&1; then
+  gcloud scheduler jobs update http "$JOB_NAME" "${SCHEDULER_ARGS[@]}"
+else
+  gcloud scheduler jobs create http "$JOB_NAME" "${SCHEDULER_ARGS[@]}"
+fi
+echo "Reconciler scheduled: $RECONCILE_SCHEDULE"
+
 # Output the deployed URL
 URL=$(gcloud run services describe "$SERVICE_NAME" --region="$REGION" --format "value(status.url)")
 echo "✅ Deployment successful. Service URL: $URL"
\ No newline at end of file
@@ -1,23 +1,38 @@
-from google.cloud import storage
 import os
-from datetime import timedelta
-from google.oauth2 import service_account
+import queue
+import threading
+from datetime import datetime, timedelta
 import logging
 
-storage_client = storage.Client()
+from startup import initialize_once
 
 logger = logging.getLogger(__name__)
 BUCKET_NAME = os.getenv("GCP_BUCKET_NAME")
 GCS_SA_KEY_PATH = "/secrets/gcs-key/sa.json"
 
-if os.path.exists(GCS_SA_KEY_PATH):
-    gcs_credentials = service_account.Credentials.from_service_account_file(GCS_SA_KEY_PATH)
-    storage_client = storage.Client(credentials=gcs_credentials)
-else:
-    storage_client = storage.Client()
+# A GCS batch request carries at most 100 calls.
+GCS_BATCH_SIZE = 100
+GCS_DELETE_MAX_ATTEMPTS = int(os.getenv("GCS_DELETE_MAX_ATTEMPTS", "5"))
+# Up to this many objects are looked up one by one rather than by listing their folder.
+GCS_GET_BLOB_LIMIT = 20
+
+# ((gcs_path, generation), attempt) pairs waiting for the background delete worker.
+# It lives in memory and is lost when the instance stops; the scheduled reconciler
+# (see deploy.sh) removes whatever it leaves behind.
+_delete_queue: queue.Queue = queue.Queue()
+
+@initialize_once
+def get_storage_client():
+    from google.cloud import storage
+    from google.oauth2 import service_account
+
+    if os.path.exists(GCS_SA_KEY_PATH):
+        gcs_credentials = service_account.Credentials.from_service_account_file(GCS_SA_KEY_PATH)
+        return storage.Client(credentials=gcs_credentials)
+    return storage.Client()
 
 def generateUploadUrl(gcs_path: str, content_type: str, doc_id: int) -> str:
-    bucket = storage_client.bucket(BUCKET_NAME)
+    bucket = get_storage_client().bucket(BUCKET_NAME)
     blob = bucket.blob(gcs_path)
     
     url = blob.generate_signed_url(
@@ -30,23 +45,135 @@ def generateUploadUrl(gcs_path: str, content_type: str, doc_id: int) -> str:
     return url
 
 def generatePreviewUrl(gcs_path):
-    bucket = storage_client.bucket(BUCKET_NAME)
+    bucket = get_storage_client().bucket(BUCKET_NAME)
     blob = bucket.blob(gcs_path)
     url = blob.generate_signed_url(
         version="v4", expiration=timedelta(minutes=60), method="GET", response_disposition="inline"
     )
     return url
 
-def delete_gcs_object(gcs_path: str):
-    logger.info(f"Attempting to delete GCS object: {gcs_path}")
+def get_gcs_generations(gcs_paths: list[str]) -> dict[str, int]:
+    """Returns the current generation of each path that exists.
+
+    A few paths are fetched one by one. Larger sets list each folder (i.e. user prefix)
+    once instead, which costs one call per 1000 objects the user owns.
+    """
+    client = get_storage_client()
+    wanted = set(gcs_paths)
+    generations = {}
+    if len(wanted) <= GCS_GET_BLOB_LIMIT:
+        bucket = client.bucket(BUCKET_NAME)
+        for gcs_path in wanted:
+            blob = bucket.get_blob(gcs_path)
+            if blob is not None:
+                generations[gcs_path] = blob.generation
+        return generations
+
+    prefixes = {gcs_path.rsplit("/", 1)[0] + "/" if "/" in gcs_path else "" for gcs_path in wanted}
+    for prefix in prefixes:
+        for blob in client.list_blobs(BUCKET_NAME, prefix=prefix):
+            if blob.name in wanted:
+                generations[blob.name] = blob.generation
+    return generations
+
+def delete_gcs_objects(objects: list[tuple[str, int]]) -> list[tuple[str, int]]:
+    """Deletes (gcs_path, generation) pairs with batch requests and returns the ones that failed.
+
+    Each delete only matches the given generation, so an object uploaded again to the same
+    path in the meantime is left alone. Objects that are gone or replaced count as deleted.
+    """
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+
+    client = get_storage_client()
+    bucket = client.bucket(BUCKET_NAME)
+    failed = []
+    for i in range(0, len(objects), GCS_BATCH_SIZE):
+        batch_objects = objects[i:i + GCS_BATCH_SIZE]
+        try:
+            with client.batch():
+                for gcs_path, generation in batch_objects:
+                    bucket.blob(gcs_path).delete(if_generation_match=generation)
+            logger.info(f"Deleted {len(batch_objects)} GCS objects in one batch request.")
+        except Exception:
+            # A batch only reports its first failure, so redo the calls one by one to find
+            # out which ones failed. Objects the batch did delete now return NotFound.
+            for gcs_path, generation in batch_objects:
+                try:
+                    bucket.blob(gcs_path).delete(if_generation_match=generation)
+                except (NotFound, PreconditionFailed):
+                    pass
+                except Exception:
+                    logger.warning(f"Failed to delete GCS object {gcs_path}#{generation}.", exc_info=True)
+                    failed.append((gcs_path, generation))
+    return failed
+
+def enqueue_gcs_deletes(gcs_paths: list[str]):
+    """Queues objects for deletion by the background worker, which retries failures with backoff.
+
+    The generations are looked up now, before the caller responds, so a file the user
+    uploads again to the same path afterwards is never deleted by a late retry.
+    """
+    if not gcs_paths:
+        return
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(gcs_path)
-        blob.delete()
-        logger.info(f"Successfully deleted GCS object: {gcs_path}")
-    except Exception as e:
+        generations = get_gcs_generations(gcs_paths)
+    except Exception:
         logger.error(
-            f"Failed to delete GCS object {gcs_path}. This may require "
-            f"manual cleanup in the GCS bucket.", 
+            f"Could not look up GCS objects {gcs_paths} for deletion. "
+            f"The reconciler will remove them on its next run.",
             exc_info=True
         )
+        return
+    _start_delete_worker()
+    for gcs_path, generation in generations.items():
+        _delete_queue.put(((gcs_path, generation), 1))
+
+@initialize_once
+def _start_delete_worker() -> threading.Thread:
+    worker = threading.Thread(target=_delete_worker, name="gcs-delete", daemon=True)
+    worker.start()
+    return worker
+
+def _retry_later(gcs_object: tuple[str, int], attempt: int):
+    timer = threading.Timer(2 ** attempt, _delete_queue.put, args=((gcs_object, attempt + 1),))
+    timer.daemon = True
+    timer.start()
+
+def _delete_worker():
+    while True:
+        # Block for the first object, then take whatever else is waiting to fill a batch.
+        items = [_delete_queue.get()]
+        while len(items) < GCS_BATCH_SIZE:
+            try:
+                items.append(_delete_queue.get_nowait())
+            except queue.Empty:
+                break
+        attempts = dict(items)
+
+        try:
+            failed = delete_gcs_objects(list(attempts))
+        except Exception:
+            logger.error("GCS delete batch failed.", exc_info=True)
+            failed = list(attempts)
+
+        for gcs_object in failed:
+            attempt = attempts[gcs_object]
+            if attempt >= GCS_DELETE_MAX_ATTEMPTS:
+                logger.error(
+                    f"Giving up on deleting GCS object {gcs_object[0]} after {attempt} attempts. "
+                    f"The reconciler will remove it on its next run."
+                )
+            else:
+                _retry_later(gcs_object, attempt)
+
+def list_gcs_objects() -> list[tuple[str, int, datetime]]:
+    """Returns (name, generation, time_created) for every object this app uploaded.
+
+    Uploads are written to `{user_id}/{filename}` with a document-id metadata field
+    (see generateUploadUrl). Anything else in the bucket is not ours and is left out.
+    """
+    return [
+        (blob.name, blob.generation, blob.time_created)
+        for blob in get_storage_client().list_blobs(BUCKET_NAME)
+        if "/" in blob.name and "document-id" in (blob.metadata or {})
+    ]
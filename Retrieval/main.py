@@ -1,3 +1,5 @@
+from startup import deferred_import, start_warm_up
+
 from fastapi import FastAPI, HTTPException, Depends
 from pydantic import BaseModel
 from typing import List, Optional
@@ -5,9 +7,10 @@ from fastapi.middleware.cors import CORSMiddleware
 import logging
 from datetime import datetime
 
-from database_utils import list_user_documents, query_vector_store, check_for_duplicate, get_user_stats, create_upload_record, get_document_status_by_id, get_gcs_path_by_doc_id, delete_document_records
-from gcp_utils import generateUploadUrl, generatePreviewUrl, delete_gcs_object
-from auth import verify_token
+from database_utils import DocumentBeingDeletedError, list_user_documents, query_vector_store, check_for_duplicate, get_user_stats, create_upload_record, get_document_status_by_id, get_gcs_path_by_doc_id, mark_documents_deleting, delete_document_records, get_db_pool
+from gcp_utils import generateUploadUrl, generatePreviewUrl, enqueue_gcs_deletes, get_storage_client
+from auth import verify_token, get_firebase_auth
+from embeddings import PROVIDER_MODULES, get_embedding_provider
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -29,6 +32,19 @@ app.add_middleware(
 
 logging.info("--- Query API Service v2 is starting up! ---")
 
+@app.on_event("startup")
+def warm_up():
+    start_warm_up({
+        "import firebase_admin": deferred_import("firebase_admin"),
+        "import google.cloud.storage": deferred_import("google.cloud.storage"),
+        **{f"import {module}": deferred_import(module) for module in PROVIDER_MODULES},
+        "firebase_auth": get_firebase_auth,
+        "storage_client": get_storage_client,
+        "db_pool": get_db_pool,
+        "db_connection": lambda: get_db_pool().connect().close(),
+        "embedding_provider": get_embedding_provider,
+    })
+
 class QueryRequest(BaseModel):
     query: str
 
@@ -54,6 +70,11 @@ class InitiateUploadRequest(BaseModel):
 class UserStats(BaseModel):
     document_count: int
     total_storage_bytes: int
+
+class BulkDeleteRequest(BaseModel):
+    doc_ids: List[int]
+
+MAX_BULK_DELETE_IDS = 1000
     
 #only changed what it resturns
 @app.post("/documents/initiate-upload")
@@ -76,6 +97,8 @@ async def initiate_upload(request: InitiateUploadRequest, user: dict = Depends(v
             "doc_id": doc_id
         }
 
+    except DocumentBeingDeletedError:
+        raise HTTPException(status_code=409, detail="A previous copy of this file is still being deleted. Please try again shortly.")
     except Exception as e:
         logger.error(f"Failed to initiate upload for user {uid}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Could not initiate upload.")
@@ -164,19 +187,19 @@ async def get_status(doc_id: int, user: dict = Depends(verify_token)):
     return {"status": status}
 
 @app.delete("/documents/{doc_id}", status_code=200)
-async def delete_document(doc_id: int, user: dict = Depends(verify_token)):
+def delete_document(doc_id: int, user: dict = Depends(verify_token)):
     uid = user.get("uid")
     if not uid:
         raise HTTPException(status_code=401, detail="User ID missing in token")
 
     try:
-        gcs_path_to_delete = get_gcs_path_by_doc_id(uid, doc_id)
-        if not gcs_path_to_delete:
+        documents = mark_documents_deleting(uid, [doc_id])
+        if not documents:
             raise HTTPException(status_code=404, detail="Document not found or user does not have permission.")
 
-        delete_document_records(doc_id)
+        gcs_paths_to_delete = delete_document_records([doc_id])
 
-        delete_gcs_object(gcs_path_to_delete)
+        enqueue_gcs_deletes(gcs_paths_to_delete)
 
         return {"status": "success", "message": f"Document ID {doc_id} was successfully deleted."}
 
@@ -185,4 +208,29 @@ async def delete_document(doc_id: int, user: dict = Depends(verify_token)):
     except Exception as e:
         logger.error(f"An unexpected error occurred while deleting document {doc_id} for user {uid}.", exc_info=True)
         raise HTTPException(status_code=500, detail="An error occurred while deleting the document.")
-    
\ No newline at end of file
+
+@app.post("/documents/bulk-delete", status_code=200)
+def bulk_delete_documents(request: BulkDeleteRequest, user: dict = Depends(verify_token)):
+    uid = user.get("uid")
+    if not uid:
+        raise HTTPException(status_code=401, detail="User ID missing in token")
+    if not request.doc_ids:
+        raise HTTPException(status_code=400, detail="No document IDs provided.")
+    if len(request.doc_ids) > MAX_BULK_DELETE_IDS:
+        raise HTTPException(status_code=400, detail=f"Cannot delete more than {MAX_BULK_DELETE_IDS} documents per request.")
+
+    doc_ids = list(dict.fromkeys(request.doc_ids))
+    try:
+        documents = mark_documents_deleting(uid, doc_ids)
+        if documents:
+            gcs_paths_to_delete = delete_document_records(list(documents))
+            enqueue_gcs_deletes(gcs_paths_to_delete)
+
+        return {
+            "status": "success",
+            "deleted": list(documents),
+            "not_found": [doc_id for doc_id in doc_ids if doc_id not in documents],
+        }
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while bulk deleting {len(doc_ids)} documents for user {uid}.", exc_info=True)
+        raise HTTPException(status_code=500, detail="An error occurred while deleting the documents.")
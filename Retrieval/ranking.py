@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+
+# How many candidates to fetch per result slot before diversifying.
+MMR_FETCH_MULTIPLIER = int(os.getenv("MMR_FETCH_MULTIPLIER", "4"))
+
+# 1.0 ranks purely by relevance; lower values trade relevance for variety.
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+
+
+def parse_vector(vector_text: str) -> np.ndarray:
+    """Parses pgvector's text output, e.g. "[0.1,0.2,...]"."""
+    return np.array(vector_text.strip("[]").split(","), dtype=np.float32)
+
+
+def mmr_select(relevance: np.ndarray, embeddings: np.ndarray, k: int, lambda_mult: float = MMR_LAMBDA) -> list[int]:
+    """Picks up to k candidates by maximal marginal relevance and returns their indices in pick order.
+
+    `relevance` holds each candidate's cosine similarity to the query and `embeddings`
+    their vectors, one row per candidate. Each step picks the candidate with the best
+    lambda * relevance - (1 - lambda) * (highest similarity to anything already picked).
+    """
+    n = len(relevance)
+    if n == 0 or k <= 0:
+        return []
+
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    normalized = embeddings / np.where(norms == 0, 1, norms)
+    similarity = normalized @ normalized.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < min(k, n):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+
+    return selected
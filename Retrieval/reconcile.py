@@ -0,0 +1,110 @@
+"""Finds and removes documents and GCS objects that have lost their counterpart, and re-embeds stale chunks.
+
+Meant to run on a schedule (e.g. as a Cloud Run job) from this directory:
+
+    python reconcile.py [--dry-run] [--grace-minutes 60]
+
+It cleans up these leftovers:
+- documents stuck in DELETING because a delete request died halfway,
+- documents whose GCS object is gone (including uploads that never happened),
+- GCS objects that no document refers to, e.g. after a failed background delete
+  (only objects uploaded through the app count, see gcp_utils.list_gcs_objects),
+- chunks embedded by another model than the configured EMBEDDING_PROVIDER's.
+
+Switching EMBEDDING_PROVIDER: redeploy both services with the new provider, then run
+this job (`gcloud run jobs execute query-api-reconciler`). Search only matches chunks
+embedded by the current model, so older chunks are missing from results until they
+are re-embedded. A run that times out carries on where it stopped on the next run.
+"""
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+
+from database_utils import (
+    copy_linked_chunk_embeddings, count_chunks_to_reembed, delete_document_records,
+    list_chunks_to_reembed, list_documents_for_reconcile, list_referenced_gcs_paths, update_chunk_embeddings,
+)
+from embeddings import get_embedding_provider
+from gcp_utils import delete_gcs_objects, list_gcs_objects
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Leave anything touched more recently than this alone so in-flight uploads and deletes can finish.
+DEFAULT_GRACE_MINUTES = 60
+
+REEMBED_BATCH_SIZE = 100
+
+
+def reembed_stale_chunks(dry_run: bool = False) -> int:
+    """Moves chunks embedded by another model onto the configured one and returns how many were moved."""
+    provider = get_embedding_provider()
+    if dry_run:
+        return count_chunks_to_reembed(provider.model_name)
+
+    reembedded = 0
+    while True:
+        chunks = list_chunks_to_reembed(provider.model_name, limit=REEMBED_BATCH_SIZE)
+        if not chunks:
+            break
+        embeddings = provider.embed_documents([chunk["chunk_text"] for chunk in chunks])
+        if len(embeddings) != len(chunks):
+            raise ValueError(f"Got {len(embeddings)} embeddings for {len(chunks)} chunks.")
+        update_chunk_embeddings([chunk["id"] for chunk in chunks], embeddings, provider.model_name)
+        reembedded += len(chunks)
+    # Linked near-duplicates take their target's new vector instead of being embedded again.
+    return reembedded + copy_linked_chunk_embeddings(provider.model_name)
+
+
+def reconcile(grace_minutes: int = DEFAULT_GRACE_MINUTES, dry_run: bool = False) -> dict:
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=grace_minutes)
+    gcs_objects = list_gcs_objects()
+    generations = {name: generation for name, generation, _ in gcs_objects}
+
+    # Documents untouched since before the cutoff that are half-deleted or point at nothing.
+    orphaned_doc_ids = [
+        document["id"]
+        for document in list_documents_for_reconcile(grace_minutes)
+        if document["processing_status"] == "DELETING" or document["gcs_path"] not in generations
+    ]
+
+    referenced_paths = list_referenced_gcs_paths()
+    orphaned_objects = [
+        (name, generation) for name, generation, time_created in gcs_objects
+        if name not in referenced_paths and time_created < cutoff
+    ]
+
+    logger.info(
+        f"Reconciler found {len(orphaned_doc_ids)} orphaned documents and "
+        f"{len(orphaned_objects)} orphaned GCS objects (dry run: {dry_run})."
+    )
+    failed_objects = []
+    if not dry_run:
+        if orphaned_doc_ids:
+            # Half-deleted documents may still have their object. Deletes are pinned to the
+            # generation listed above, so an object uploaded since then is left alone.
+            freed_paths = delete_document_records(orphaned_doc_ids)
+            orphaned_objects = list(dict.fromkeys(
+                orphaned_objects + [(path, generations[path]) for path in freed_paths if path in generations]
+            ))
+        failed_objects = delete_gcs_objects(orphaned_objects)
+        if failed_objects:
+            logger.error(f"Could not delete {len(failed_objects)} GCS objects: {failed_objects}")
+
+    reembedded_chunks = reembed_stale_chunks(dry_run)
+    logger.info(f"Reconciler {'found' if dry_run else 're-embedded'} {reembedded_chunks} chunks from another embedding model.")
+
+    return {
+        "reembedded_chunks": reembedded_chunks,
+        "orphaned_documents": orphaned_doc_ids,
+        "orphaned_objects": orphaned_objects,
+        "failed_objects": failed_objects,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed.")
+    parser.add_argument("--grace-minutes", type=int, default=DEFAULT_GRACE_MINUTES)
+    args = parser.parse_args()
+    reconcile(grace_minutes=args.grace_minutes, dry_run=args.dry_run)